@@ -1,16 +1,22 @@
 import logging
 import asyncio
+import json
 import os
+import random
+import time
+from collections import Counter
 from datetime import datetime, timedelta
-import pytz # Import pytz for timezone handling
+from zoneinfo import ZoneInfo # Stdlib timezone handling
 
-# Import aiosqlite for asynchronous database operations
-import aiosqlite
-from aiogram import Bot, Dispatcher, Router, types, F
+# Stdlib sqlite3: this bot has a single writer, so the synchronous driver is
+# faster than routing every statement through aiosqlite's worker thread.
+import sqlite3
+from aiogram import BaseMiddleware, Bot, Dispatcher, Router, types, F
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.filters import Command
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, ChatPermissions
 from aiogram.enums import ChatType
-from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
 
 # For loading environment variables (e.g., API_TOKEN, OWNER_ID)
 from dotenv import load_dotenv
@@ -37,67 +43,358 @@ if not API_TOKEN:
 DATABASE_NAME = 'top_engaged_db.sqlite' # Changed database name
 
 # Set timezone for scheduled tasks (Saudi Arabia Time)
-SAUDI_ARABIA_TIMEZONE = pytz.timezone('Asia/Riyadh')
+SAUDI_ARABIA_TIMEZONE = ZoneInfo('Asia/Riyadh')
 
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Initialize Bot and Router
-bot = Bot(token=API_TOKEN)
+# Initialize Bot and Router. The session's connector is widened so the
+# concurrent notification/promotion fan-outs reuse warm TLS connections
+# instead of paying a handshake per API call.
+API_SESSION = AiohttpSession()
+API_SESSION._connector_init.update(limit=50, ttl_dns_cache=300, keepalive_timeout=75)
+bot = Bot(token=API_TOKEN, session=API_SESSION)
 dp = Dispatcher()
 router = Router()
 
-# Global variables for connection and cursor (will be managed by startup/shutdown hooks)
+# Global connection (managed by startup/shutdown hooks). Statements run
+# through per-call cursors from db_conn.execute(), so no cursor is shared.
 db_conn = None
-db_cursor = None
+
+# In-memory cache of the main group chat ID. Loaded once in init_db and kept
+# in sync by set_group_chat_id, so the per-message hot path never hits SQLite
+# just to compare a chat id.
+MAIN_GROUP_ID = None
+
+# In-memory mirror of the deputies table. Loaded once in init_db and mutated
+# alongside the add/remove/clear commands, so permission checks are a set
+# lookup instead of a query.
+DEPUTIES: set = set()
+
+class TelegramRateLimiter:
+    """Token-bucket limiter keeping Telegram API calls under the global rate.
+
+    Telegram allows roughly 30 requests/s bot-wide; concurrent pipelines
+    acquire a token before each call so bursts spread out instead of
+    tripping 429s.
+    """
+
+    def __init__(self, rate: float = 30.0, burst: float = 30.0):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Always take the token; a negative balance is a debt the caller
+            # sleeps off, so the refill for the slept interval merely repays
+            # it instead of double-crediting the bucket.
+            self.tokens -= 1
+            if self.tokens < 0:
+                await asyncio.sleep(-self.tokens / self.rate)
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+API_RATE_LIMITER = TelegramRateLimiter()
+
+async def rate_limited_call(coro_factory):
+    """Runs a Telegram API call through the rate limiter, honoring 429s."""
+    while True:
+        async with API_RATE_LIMITER:
+            try:
+                return await coro_factory()
+            except TelegramRetryAfter as e:
+                await asyncio.sleep(e.retry_after + random.random())
+
+# Telegram may briefly report a just-promoted user as not an administrator;
+# errors containing these markers are worth retrying rather than surfacing.
+TRANSIENT_PROMOTION_ERRORS = ("USER_NOT_PARTICIPANT", "ADMIN_RANK_INVALID",
+                              "user is not an administrator")
+
+async def with_retry(coro_factory, *, retries: int = 8, base: float = 0.25):
+    """Runs a rate-limited call, retrying transient propagation errors with
+    exponential backoff plus jitter."""
+    for attempt in range(retries):
+        try:
+            return await rate_limited_call(coro_factory)
+        except TelegramBadRequest as e:
+            message = str(e)
+            if attempt == retries - 1 or not any(marker in message for marker in TRANSIENT_PROMOTION_ERRORS):
+                raise
+            await asyncio.sleep(base * 2 ** attempt + random.random() * 0.1)
+
+# After the owner blocks the bot, every further owner send is a wasted round
+# trip that fails the same way; mute them for an hour instead.
+_owner_notify_muted_until = 0.0
+
+async def notify_owner(text: str):
+    """Sends a status message to the owner, muting sends for an hour after a
+    Forbidden error so error branches don't pile up doomed API calls."""
+    global _owner_notify_muted_until
+    if time.monotonic() < _owner_notify_muted_until:
+        logging.warning(f"Owner notification suppressed (owner unreachable): {text}")
+        return
+    try:
+        await bot.send_message(OWNER_ID, text)
+    except TelegramForbiddenError:
+        _owner_notify_muted_until = time.monotonic() + 3600
+        logging.error(f"Cannot send message to owner {OWNER_ID}. User blocked bot; muting owner notifications for an hour.")
+    except Exception as e:
+        logging.error(f"Error sending owner notification: {e}")
+
+# Shared reply strings, hoisted so repeated authorization/availability
+# failures don't rebuild the same literals per invocation.
+MSG_DB_UNAVAILABLE = "عذراً، قاعدة البيانات غير متاحة حالياً."
+MSG_COMMAND_NEEDS_TEXT = "هذا الأمر يتطلب نصًا."
+MSG_USER_ID_NOT_NUMERIC = "معرف المستخدم (user_id) يجب أن يكون رقمًا."
+MSG_NO_RUN_PERMISSION = "ليس لديك صلاحية لتشغيل هذا الأمر."
+MSG_NO_DEPUTIES = "لا يوجد نواب حاليًا."
+
+# Bounds the deputy-notification fan-out below Telegram's ~30 msg/s ceiling.
+NOTIFY_SEMAPHORE = asyncio.Semaphore(25)
+
+# Bot username, fetched once at startup; it cannot change while the process
+# lives, so /start should not pay a get_me round-trip per invocation.
+BOT_USERNAME = None
+
+# Memoized deputy display names (user_id -> (cached_at, (username,
+# full_name))). Deputy identities rarely change, so /list_deputies only pays
+# get_chat round-trips for IDs it has never resolved — but entries expire
+# after an hour so renames eventually show up.
+DEPUTY_NAME_CACHE: dict = {}
+DEPUTY_NAME_TTL_SECONDS = 3600
+
+def get_cached_deputy_name(user_id: int):
+    """Returns (username, full_name) for a deputy, or None if missing/stale."""
+    entry = DEPUTY_NAME_CACHE.get(user_id)
+    if entry is None:
+        return None
+    cached_at, names = entry
+    if time.monotonic() - cached_at > DEPUTY_NAME_TTL_SECONDS:
+        del DEPUTY_NAME_CACHE[user_id]
+        return None
+    return names
+
+def cache_deputy_name(user_id: int, username, full_name):
+    DEPUTY_NAME_CACHE[user_id] = (time.monotonic(), (username, full_name))
+
+# Write-behind buffer for message counting. Handlers only touch these dicts;
+# a background task flushes them to SQLite in one transaction every few seconds,
+# so we pay one commit (fsync) per flush window instead of one per message.
+pending_counts: Counter = Counter()  # user_id -> count delta since last flush
+pending_names: dict = {}  # user_id -> (username, full_name) latest seen
+
+# Set once init_db has finished, so startup tasks can wait for the database
+# without polling.
+DB_READY = asyncio.Event()
+
+# Names as last written to the database, per user. Lets the flusher issue a
+# count-only UPDATE for users whose username/full_name haven't changed,
+# keeping unchanged columns out of the WAL.
+LAST_NAMES: dict = {}
+
+FLUSH_INTERVAL_SECONDS = 5
+
+# A message burst shouldn't have to wait out the full interval: once this
+# many users have buffered increments, the flusher is woken immediately.
+FLUSH_THRESHOLD = 200
+FLUSH_WAKEUP = asyncio.Event()
+
+UPSERT_COUNTS_SQL = """
+INSERT INTO message_counts (user_id, username, full_name, message_count)
+VALUES (?, ?, ?, ?)
+ON CONFLICT(user_id) DO UPDATE SET
+    message_count = message_count + excluded.message_count,
+    username = excluded.username,
+    full_name = excluded.full_name
+"""
+
+INC_COUNT_ONLY_SQL = "UPDATE message_counts SET message_count = message_count + ? WHERE user_id = ?"
+
+# Hot-path SQL hoisted to module constants. sqlite3 keys its internal
+# statement cache on the SQL text, so reusing the same string objects (plus
+# the enlarged cached_statements below) means these are parsed/planned once
+# per process instead of on every execute().
+SQL_GET_SETTING = "SELECT setting_value FROM bot_settings WHERE setting_name = ?"
+SQL_SET_SETTING = "INSERT OR REPLACE INTO bot_settings (setting_name, setting_value) VALUES (?, ?)"
+# The whole schema in one script: four tables, plus a covering index that
+# turns the top-3 queries into a 3-row index descent and one that keeps the
+# latest-week history lookup a single seek as the table accumulates rows.
+SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS message_counts (
+    user_id INTEGER PRIMARY KEY,
+    message_count INTEGER DEFAULT 0,
+    username TEXT,
+    full_name TEXT
+);
+CREATE TABLE IF NOT EXISTS deputies (
+    user_id INTEGER PRIMARY KEY,
+    username TEXT,
+    full_name TEXT,
+    cached_at INTEGER
+);
+CREATE TABLE IF NOT EXISTS top_engaged_history (
+    week_start_date TEXT PRIMARY KEY,
+    top_1_user_id INTEGER,
+    top_2_user_id INTEGER,
+    top_3_user_id INTEGER,
+    top_1_username TEXT,
+    top_2_username TEXT,
+    top_3_username TEXT
+);
+CREATE TABLE IF NOT EXISTS bot_settings (
+    setting_name TEXT PRIMARY KEY,
+    setting_value TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_mc_count
+ON message_counts(message_count DESC, user_id, username, full_name);
+CREATE INDEX IF NOT EXISTS idx_teh_week_desc
+ON top_engaged_history(week_start_date DESC, top_1_username, top_2_username, top_3_username);
+"""
+
+SQL_GET_USER_COUNT = "SELECT message_count FROM message_counts WHERE user_id=?"
+SQL_TOP3 = "SELECT user_id, username, full_name, message_count FROM message_counts WHERE message_count > 0 ORDER BY message_count DESC LIMIT 3"
+SQL_INSERT_HISTORY = """
+INSERT OR IGNORE INTO top_engaged_history (week_start_date, top_1_user_id, top_2_user_id, top_3_user_id, top_1_username, top_2_username, top_3_username)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+SQL_RESET_COUNTS = "UPDATE message_counts SET message_count = 0"
 
 # --- Database Initialization and Management ---
 async def init_db():
-    """Initializes the SQLite database connection asynchronously."""
-    global db_conn, db_cursor
+    """Initializes the SQLite database connection."""
+    global db_conn
     logging.info(f"Initializing database: {DATABASE_NAME}")
-    db_conn = await aiosqlite.connect(DATABASE_NAME)
-    db_cursor = await db_conn.cursor()
-
-    await db_cursor.execute("""
-    CREATE TABLE IF NOT EXISTS message_counts (
-        user_id INTEGER PRIMARY KEY,
-        message_count INTEGER DEFAULT 0,
-        username TEXT,
-        full_name TEXT
-    )
-    """)
-    await db_cursor.execute("""
-    CREATE TABLE IF NOT EXISTS deputies (
-        user_id INTEGER PRIMARY KEY
-    )
-    """)
-    await db_cursor.execute("""
-    CREATE TABLE IF NOT EXISTS top_engaged_history (
-        week_start_date TEXT PRIMARY KEY,
-        top_1_user_id INTEGER,
-        top_2_user_id INTEGER,
-        top_3_user_id INTEGER,
-        top_1_username TEXT,
-        top_2_username TEXT,
-        top_3_username TEXT
-    )
-    """)
-    await db_cursor.execute("""
-    CREATE TABLE IF NOT EXISTS bot_settings (
-        setting_name TEXT PRIMARY KEY,
-        setting_value TEXT
-    )
-    """)
-    await db_conn.commit()
+    db_conn = sqlite3.connect(DATABASE_NAME, check_same_thread=False,
+                              isolation_level=None, cached_statements=256)
+    # By-name column access in the handlers; rows still unpack like tuples.
+    db_conn.row_factory = sqlite3.Row
+    db_conn.execute("PRAGMA journal_mode=WAL")
+    db_conn.execute("PRAGMA synchronous=NORMAL")
+    db_conn.execute("PRAGMA temp_store=MEMORY")
+    db_conn.execute("PRAGMA mmap_size=134217728")  # 128 MiB
+    db_conn.execute("PRAGMA cache_size=-20000")  # ~20 MB page cache
+    db_conn.execute("PRAGMA busy_timeout=5000")
+    db_conn.execute("PRAGMA foreign_keys=ON")
+    # Let the WAL grow further before implicit checkpoints so flush commits
+    # never stall on one; the background task truncates it during idle time.
+    db_conn.execute("PRAGMA wal_autocheckpoint=2000")
+
+    # One batch for the whole schema instead of a statement per object.
+    db_conn.executescript(SCHEMA_SQL)
+    # Older databases predate the deputy name columns; add them in place.
+    deputy_columns = {row[1] for row in db_conn.execute("PRAGMA table_info(deputies)")}
+    if "username" not in deputy_columns:
+        db_conn.execute("ALTER TABLE deputies ADD COLUMN username TEXT")
+        db_conn.execute("ALTER TABLE deputies ADD COLUMN full_name TEXT")
+    if "cached_at" not in deputy_columns:
+        db_conn.execute("ALTER TABLE deputies ADD COLUMN cached_at INTEGER")
+    db_conn.execute("ANALYZE")
     logging.info("Database tables checked/created successfully.")
 
+    # Warm the main-group cache so message_counter never queries for it.
+    global MAIN_GROUP_ID
+    MAIN_GROUP_ID = await get_group_chat_id()
+
+    # Warm the deputy cache so permission checks never hit the database.
+    DEPUTIES.update(row[0] for row in db_conn.execute("SELECT user_id FROM deputies"))
+
+    DB_READY.set()
+
+async def flush_pending_counts():
+    """Flushes buffered message-count increments to the database in one transaction."""
+    if not pending_counts or db_conn is None:
+        return
+    # Snapshot and clear the buffers before awaiting anything so increments
+    # arriving during the flush land in the next window instead of being lost.
+    counts_snapshot = dict(pending_counts)
+    names_snapshot = dict(pending_names)
+    pending_counts.clear()
+    pending_names.clear()
+    # Users whose names are unchanged since the last write get a lightweight
+    # count-only UPDATE; new users and name changes go through the full UPSERT.
+    upsert_rows = []
+    count_only_rows = []
+    for user_id, delta in counts_snapshot.items():
+        names = names_snapshot.get(user_id)
+        if names is not None and LAST_NAMES.get(user_id) == names:
+            count_only_rows.append((delta, user_id))
+        else:
+            username, full_name = names if names is not None else (None, None)
+            upsert_rows.append((user_id, username, full_name, delta))
+            if names is not None:
+                LAST_NAMES[user_id] = names
+    # IMMEDIATE takes the write lock upfront instead of upgrading mid-
+    # transaction, which can surface SQLITE_BUSY under a concurrent reader.
+    try:
+        db_conn.execute("BEGIN IMMEDIATE")
+        if count_only_rows:
+            db_conn.executemany(INC_COUNT_ONLY_SQL, count_only_rows)
+        if upsert_rows:
+            db_conn.executemany(UPSERT_COUNTS_SQL, upsert_rows)
+        db_conn.commit()
+    except Exception:
+        # Roll back so the connection isn't left mid-transaction, and merge
+        # the snapshot back so a transient failure delays these counts to the
+        # next flush instead of dropping them.
+        db_conn.rollback()
+        pending_counts.update(counts_snapshot)
+        for user_id, names in names_snapshot.items():
+            pending_names.setdefault(user_id, names)
+        # The names in these rows were never written, so forget them or the
+        # retry would wrongly take the count-only path.
+        for user_id, _username, _full_name, _delta in upsert_rows:
+            LAST_NAMES.pop(user_id, None)
+        raise
+    logging.debug(f"Flushed message counts for {len(counts_snapshot)} users.")
+
+async def flush_counts_task():
+    """Background task that flushes buffered message counts every interval,
+    or sooner when the buffer crosses FLUSH_THRESHOLD."""
+    while True:
+        try:
+            await asyncio.wait_for(FLUSH_WAKEUP.wait(), timeout=FLUSH_INTERVAL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        FLUSH_WAKEUP.clear()
+        try:
+            await flush_pending_counts()
+        except Exception as e:
+            logging.error(f"Error flushing message counts: {e}")
+
+async def wal_checkpoint_task():
+    """Background task that periodically truncates the WAL so sustained
+    message traffic cannot grow it unbounded between implicit checkpoints."""
+    while True:
+        await asyncio.sleep(300)
+        if db_conn is None:
+            continue
+        try:
+            db_conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        except Exception as e:
+            logging.error(f"WAL checkpoint failed: {e}")
+
 async def close_db():
-    """Closes the SQLite database connection asynchronously."""
+    """Closes the SQLite database connection."""
     global db_conn
     if db_conn:
         logging.info("Closing database connection.")
-        await db_conn.close()
+        try:
+            await flush_pending_counts()
+        except Exception as e:
+            logging.error(f"Error flushing message counts on shutdown: {e}")
+        db_conn.execute("PRAGMA optimize")
+        db_conn.close()
         db_conn = None
 
 # Register startup and shutdown hooks for the database
@@ -106,29 +403,35 @@ dp.shutdown.register(close_db)
 
 # --- Helper Functions ---
 
-def is_owner(user_id: int) -> bool:
-    """Checks if the given user ID is the bot owner."""
-    return user_id == OWNER_ID
-
-async def is_deputy(user_id: int) -> bool:
+def is_deputy(user_id: int) -> bool:
     """Checks if the given user ID is a deputy."""
-    if db_cursor is None:
-        logging.warning("Database not initialized yet. Cannot check deputy status.")
-        return False
-    try:
-        await db_cursor.execute("SELECT 1 FROM deputies WHERE user_id=?", (user_id,))
-        return await db_cursor.fetchone() is not None
-    except Exception as e:
-        logging.error(f"Error checking deputy status: {e}")
-        return False
+    return user_id in DEPUTIES
+
+class AuthMiddleware(BaseMiddleware):
+    """Annotates each message with the sender's privilege level.
+
+    Handlers that accept an ``is_privileged`` or ``is_owner_user`` keyword
+    get the owner/deputy checks precomputed once per update instead of
+    re-deriving them themselves.
+    """
+
+    async def __call__(self, handler, event, data):
+        user = getattr(event, "from_user", None)
+        user_id = user.id if user is not None else None
+        data["is_owner_user"] = user_id == OWNER_ID
+        data["is_privileged"] = user_id == OWNER_ID or user_id in DEPUTIES
+        return await handler(event, data)
+
+router.message.middleware(AuthMiddleware())
 
 async def get_group_chat_id():
-    """Retrieves the stored group chat ID from settings."""
-    if db_cursor is None:
+    """Retrieves the main group chat ID, serving from the in-memory cache."""
+    if MAIN_GROUP_ID is not None:
+        return MAIN_GROUP_ID
+    if db_conn is None:
         logging.warning("Database not initialized yet. Cannot get group chat ID.")
         return None
-    await db_cursor.execute("SELECT setting_value FROM bot_settings WHERE setting_name = 'main_group_chat_id'")
-    result = await db_cursor.fetchone()
+    result = db_conn.execute(SQL_GET_SETTING, ('main_group_chat_id',)).fetchone()
     if result:
         try:
             return int(result[0])
@@ -138,12 +441,14 @@ async def get_group_chat_id():
 
 async def set_group_chat_id(chat_id: int):
     """Stores the main group chat ID in settings."""
-    if db_cursor is None or db_conn is None:
+    if db_conn is None:
         logging.error("Database not initialized yet. Cannot set group chat ID.")
         return
-    await db_cursor.execute("INSERT OR REPLACE INTO bot_settings (setting_name, setting_value) VALUES (?, ?)", ('main_group_chat_id', str(chat_id)))
+    db_conn.execute(SQL_SET_SETTING, ('main_group_chat_id', str(chat_id)))
     if db_conn:
-        await db_conn.commit()
+        db_conn.commit()
+    global MAIN_GROUP_ID
+    MAIN_GROUP_ID = chat_id
     logging.info(f"Main group chat ID set to: {chat_id}")
 
 # --- TOP ENGAGED Logic ---
@@ -158,69 +463,27 @@ async def calculate_and_announce_top_engaged():
     main_group_id = await get_group_chat_id()
     if not main_group_id:
         logging.warning("Main group chat ID is not set. Cannot announce TOP ENGAGED.")
-        try:
-            await bot.send_message(OWNER_ID, "⚠️ لم يتم تحديد المجموعة الرئيسية للإعلان عن TOP ENGAGED. يرجى استخدام أمر /set_main_group **داخل المجموعة** التي تريد الإعلان فيها.")
-        except TelegramForbiddenError:
-            logging.error(f"Cannot send message to owner {OWNER_ID}. User blocked bot.")
+        await notify_owner("⚠️ لم يتم تحديد المجموعة الرئيسية للإعلان عن TOP ENGAGED. يرجى استخدام أمر /set_main_group **داخل المجموعة** التي تريد الإعلان فيها.")
         return
 
-    # Check if db_cursor is initialized
-    if db_cursor is None:
+    # Check if the database connection is initialized
+    if db_conn is None:
         logging.warning("Database cursor is not initialized. Cannot calculate top engaged users.")
         return
 
-
-async def demote_old_top_engaged(chat_id: int):
-    """
-    Demotes users who were previously set as 'TOP ENGAGED' admins,
-    removing their custom titles and administrative privileges.
-    """
-    logging.info(f"Demoting old TOP ENGAGED users in chat {chat_id}")
+    # Push any buffered increments into the table before ranking, so the
+    # write-behind cache can never cost a user their top-3 spot.
     try:
-        # Get current chat administrators
-        admins = await bot.get_chat_administrators(chat_id)
-        
-        for admin in admins:
-            user_id = admin.user.id
-            custom_title = admin.custom_title
-            
-            # Check if the custom title indicates a 'TOP ENGAGED' winner
-            if custom_title and ("TOP ENGAGED" in custom_title.upper()):
-                logging.info(f"Found old TOP ENGAGED admin: {admin.user.full_name} (ID: {user_id}) with title: {custom_title}")
-                try:
-                    # Remove all administrative privileges, effectively demoting them to a regular member
-                    # This also removes the custom title.
-                    await bot.promote_chat_member(
-                        chat_id=chat_id,
-                        user_id=user_id,
-                        can_manage_chat=False,
-                        can_delete_messages=False,
-                        can_manage_video_chats=False,
-                        can_restrict_members=False,
-                        can_promote_members=False,
-                        can_change_info=False,
-                        can_invite_users=False,
-                        can_pin_messages=False,
-                        can_post_messages=False # Ensure all are False
-                    )
-                    logging.info(f"Successfully demoted {admin.user.full_name} (ID: {user_id}) and removed custom title.")
-                    await asyncio.sleep(0.1) # Small delay to avoid hitting API limits
-                except TelegramForbiddenError:
-                    logging.warning(f"Bot lacks permission to demote user {user_id} in chat {chat_id}")
-                except TelegramBadRequest as e:
-                    logging.warning(f"Failed to demote user {user_id}: {e}")
-                except Exception as e:
-                    logging.error(f"Error demoting user {user_id}: {e}")
-            
-    except TelegramForbiddenError:
-        logging.error(f"Bot lacks 'can_promote_members' permission in chat {chat_id}. Cannot demote old TOP ENGAGED users.")
+        await flush_pending_counts()
     except Exception as e:
-        logging.error(f"Error getting chat administrators or demoting users in chat {chat_id}: {e}")
+        logging.error(f"Error flushing message counts before announcement: {e}")
+
+    # Clear out last week's winners concurrently with the ranking query and
+    # the announcement; awaited below before the new promotions start.
+    demote_task = asyncio.create_task(demote_old_top_engaged(main_group_id))
 
-    
     # Get top 3 users by message count
-    await db_cursor.execute("SELECT user_id, username, full_name, message_count FROM message_counts ORDER BY message_count DESC LIMIT 3")
-    top_users_data = await db_cursor.fetchall()
+    top_users_data = db_conn.execute(SQL_TOP3).fetchall()
 
     owner_and_deputy_notification_text_details = "" # Details for notification
     top_history_data = {
@@ -229,26 +492,13 @@ async def demote_old_top_engaged(chat_id: int):
         'top_1_username': None, 'top_2_username': None, 'top_3_username': None,
     }
 
-    announcement_text_template = (
-        "التوب الأسبوعي 🔝 \n\n"
-        "🥇المركز الاول  {top1_mention}\n\n"
-        "🥈المركز الثاني  {top2_mention}\n\n"
-        "🥉المركز الثالث  {top3_mention}\n\n"
-        "مبروك لكم لقب 🏅top engaged \n\n"
-        "وشكرا لتفاعل الجميع وحظ موفق للأسبوع القادم 🤍"
-    )
-
-
-    placeholders = {
-        'top1_mention': "غير متاح",
-        'top2_mention': "غير متاح",
-        'top3_mention': "غير متاح",
-    }
-
     if not top_users_data:
         announcement_text = "لا يوجد بيانات تفاعل كافية لهذا الأسبوع."
         owner_and_deputy_notification_text_details = "لم يتم تسجيل أي تفاعل لهذا الأسبوع."
     else:
+        # Mentions, history row and notification details are all collected in
+        # this single pass over the top-3 rows.
+        mentions = ["غير متاح", "غير متاح", "غير متاح"]
         for i, (user_id, username, full_name, count) in enumerate(top_users_data):
             # Define how the user will be mentioned/displayed
             if username:
@@ -260,21 +510,28 @@ async def demote_old_top_engaged(chat_id: int):
 
             owner_and_deputy_notification_text_details += f"\n- {display_mention} ({count} رسالة)"
 
-            # Populate history data and announcement placeholders
-            if i == 0:
-                top_history_data['top_1_user_id'] = user_id
-                top_history_data['top_1_username'] = username if username else full_name
-                placeholders['top1_mention'] = display_mention
-            elif i == 1:
-                top_history_data['top_2_user_id'] = user_id
-                top_history_data['top_2_username'] = username if username else full_name
-                placeholders['top2_mention'] = display_mention
-            elif i == 2:
-                top_history_data['top_3_user_id'] = user_id
-                top_history_data['top_3_username'] = username if username else full_name
-                placeholders['top3_mention'] = display_mention
-
-        announcement_text = announcement_text_template.format(**placeholders)
+            top_history_data[f'top_{i + 1}_user_id'] = user_id
+            top_history_data[f'top_{i + 1}_username'] = username if username else full_name
+            mentions[i] = display_mention
+
+        parts = [
+            "التوب الأسبوعي 🔝 ",
+            f"🥇المركز الاول  {mentions[0]}",
+            f"🥈المركز الثاني  {mentions[1]}",
+            f"🥉المركز الثالث  {mentions[2]}",
+            "مبروك لكم لقب 🏅top engaged ",
+            "وشكرا لتفاعل الجميع وحظ موفق للأسبوع القادم 🤍",
+        ]
+        announcement_text = "\n\n".join(parts)
+
+    # Old winners must be fully demoted before the new titles go on. Awaited
+    # here, outside the send try-block, so the task is never abandoned when
+    # the announcement itself fails; it has been running concurrently with
+    # the flush, the top-3 query and the message build above.
+    try:
+        await demote_task
+    except Exception as e:
+        logging.error(f"Demoting previous winners failed: {e}")
 
     # Announce in the main group
     try:
@@ -285,11 +542,16 @@ async def demote_old_top_engaged(chat_id: int):
         )
         logging.info(f"TOP ENGAGED announced in chat {main_group_id}. Message ID: {sent_message.message_id}")
 
-        # Give custom titles to top 3 users
-        for i, (user_id, username, full_name, count) in enumerate(top_users_data):
+        # Give custom titles to top 3 users. The three per-user pipelines run
+        # concurrently; the token bucket keeps the API calls rate-friendly.
+        titles = ["TOP ENGAGED 1", "TOP ENGAGED 2", "TOP ENGAGED 3"]
+
+        async def promote_one(i: int, user_id: int, username, full_name, count):
             try:
-                # Promote user to admin with minimal permission to ensure they become actual administrators
-                await bot.promote_chat_member(
+                # Promote straight to the final permission set: admin with
+                # only can_invite_users, which is enough to carry a custom
+                # title. One call instead of the old grant-then-strip pair.
+                await rate_limited_call(lambda: bot.promote_chat_member(
                     chat_id=main_group_id,
                     user_id=user_id,
                     can_manage_chat=False,
@@ -297,42 +559,21 @@ async def demote_old_top_engaged(chat_id: int):
                     can_manage_video_chats=False,
                     can_restrict_members=False,
                     can_promote_members=False,
-                    can_change_info=True,  # Give this minimal permission to make them admin
-                    can_invite_users=False,
+                    can_change_info=False,
+                    can_invite_users=True,
                     can_pin_messages=False,
                     can_post_messages=False
-                )
+                ))
 
-                # Wait for the promotion to take effect
-                await asyncio.sleep(1.5)
-
-                # Set custom title based on position
-                titles = ["TOP ENGAGED 1", "TOP ENGAGED 2", "TOP ENGAGED 3"]
+                # No fixed wait for the promotion to propagate: the title
+                # call retries with backoff until Telegram sees the admin.
                 try:
-                    await bot.set_chat_administrator_custom_title(
+                    await with_retry(lambda: bot.set_chat_administrator_custom_title(
                         chat_id=main_group_id,
                         user_id=user_id,
                         custom_title=titles[i]
-                    )
+                    ))
                     logging.info(f"Set custom title '{titles[i]}' for user {user_id}")
-                    
-                    # Now remove all permissions to make them admin with no actual permissions
-                    await asyncio.sleep(0.5)  # Small delay before removing permissions
-                    await bot.promote_chat_member(
-                        chat_id=main_group_id,
-                        user_id=user_id,
-                        can_manage_chat=False,
-                        can_delete_messages=False,
-                        can_manage_video_chats=False,
-                        can_restrict_members=False,
-                        can_promote_members=False,
-                        can_change_info=False,
-                        can_invite_users=True,
-                        can_pin_messages=False,
-                        can_post_messages=False
-                    )
-                    logging.info(f"Removed all permissions for user {user_id} while keeping custom title")
-                    
                 except Exception as e:
                     logging.warning(f"Failed to set custom title for user {user_id}: {e}")
 
@@ -346,13 +587,18 @@ async def demote_old_top_engaged(chat_id: int):
             except Exception as e:
                 logging.error(f"Error promoting user {user_id}: {e}")
 
+        await asyncio.gather(
+            *(promote_one(i, *user) for i, user in enumerate(top_users_data)),
+            return_exceptions=True
+        )
+
         # Pin the new message
         try:
             await bot.pin_chat_message(chat_id=main_group_id, message_id=sent_message.message_id, disable_notification=True)
             logging.info(f"TOP ENGAGED message {sent_message.message_id} pinned in chat {main_group_id}.")
         except TelegramForbiddenError:
             logging.warning(f"Bot lacks 'can_pin_messages' permission in chat {main_group_id}. Could not pin message.")
-            await bot.send_message(OWNER_ID, f"⚠️ لا يمكنني تثبيت رسالة TOP ENGAGED في المجموعة {main_group_id}. تأكد أن البوت لديه صلاحية 'تثبيت الرسائل'.")
+            await notify_owner(f"⚠️ لا يمكنني تثبيت رسالة TOP ENGAGED في المجموعة {main_group_id}. تأكد أن البوت لديه صلاحية 'تثبيت الرسائل'.")
         except TelegramBadRequest as e:
             logging.warning(f"Failed to pin message {sent_message.message_id} in chat {main_group_id}: {e}")
         except Exception as e:
@@ -360,143 +606,223 @@ async def demote_old_top_engaged(chat_id: int):
 
     except TelegramForbiddenError as e:
         logging.error(f"Bot forbidden to send messages in chat {main_group_id}: {e}")
-        try:
-            await bot.send_message(OWNER_ID, f"⚠️ لا يمكنني الإعلان في المجموعة {main_group_id}. تأكد أن البوت لديه صلاحية إرسال الرسائل.")
-        except TelegramForbiddenError:
-            logging.error(f"Cannot send message to owner {OWNER_ID}. User blocked bot.")
+        await notify_owner(f"⚠️ لا يمكنني الإعلان في المجموعة {main_group_id}. تأكد أن البوت لديه صلاحية إرسال الرسائل.")
     except Exception as e:
         logging.error(f"Error announcing TOP ENGAGED in chat {main_group_id}: {e}")
-        try:
-            await bot.send_message(OWNER_ID, f"حدث خطأ أثناء الإعلان عن TOP ENGAGED في المجموعة {main_group_id}: {e}")
-        except TelegramForbiddenError:
-            pass # Can't notify owner
-
-    # Store history
-    insert_sql = """
-    INSERT INTO top_engaged_history (week_start_date, top_1_user_id, top_2_user_id, top_3_user_id, top_1_username, top_2_username, top_3_username)
-    VALUES (?, ?, ?, ?, ?, ?, ?)
-    ON CONFLICT(week_start_date) DO UPDATE SET
-        top_1_user_id=excluded.top_1_user_id, top_2_user_id=excluded.top_2_user_id, top_3_user_id=excluded.top_3_user_id,
-        top_1_username=excluded.top_1_username, top_2_username=excluded.top_2_username, top_3_username=excluded.top_3_username
-    """
-    await db_cursor.execute(insert_sql, (
-        top_history_data['week_start_date'],
-        top_history_data['top_1_user_id'], top_history_data['top_2_user_id'], top_history_data['top_3_user_id'],
-        top_history_data['top_1_username'], top_history_data['top_2_username'], top_history_data['top_3_username']
-    ))
-    if db_conn:
-        await db_conn.commit()
-    logging.info("TOP ENGAGED history saved.")
+        await notify_owner(f"حدث خطأ أثناء الإعلان عن TOP ENGAGED في المجموعة {main_group_id}: {e}")
 
+    # Store history, record the announcement date and reset the counts as one
+    # atomic transaction: a single fsync, and no half-finalized week if the
+    # process dies partway through.
+    try:
+        db_conn.execute("BEGIN IMMEDIATE")
+        db_conn.execute(SQL_INSERT_HISTORY, (
+            top_history_data['week_start_date'],
+            top_history_data['top_1_user_id'], top_history_data['top_2_user_id'], top_history_data['top_3_user_id'],
+            top_history_data['top_1_username'], top_history_data['top_2_username'], top_history_data['top_3_username']
+        ))
         # Store the date of this announcement for scheduling purposes
-    await db_cursor.execute("INSERT OR REPLACE INTO bot_settings (setting_name, setting_value) VALUES (?, ?)",
-                            ('last_announced_week_start_date', top_history_data['week_start_date']))
-    if db_conn:
-        await db_conn.commit()
-    logging.info(f"Last announced week start date updated to {top_history_data['week_start_date']}.")
-
-    # Reset message counts for next week
-    await db_cursor.execute("UPDATE message_counts SET message_count = 0")
-    if db_conn:
-        await db_conn.commit()
-    logging.info("Message counts reset for the new week.")
+        db_conn.execute(SQL_SET_SETTING,
+                          ('last_announced_week_start_date', top_history_data['week_start_date']))
+        # Remember this week's winners so next week's demotion can target
+        # them directly instead of scanning the whole admin list.
+        winner_ids = [user[0] for user in top_users_data]
+        db_conn.execute(SQL_SET_SETTING,
+                          ('previous_top_engaged_ids', json.dumps(winner_ids)))
+        # Reset message counts for next week
+        db_conn.execute(SQL_RESET_COUNTS)
+        db_conn.commit()
+    except Exception:
+        db_conn.rollback()
+        raise
+    logging.info(f"TOP ENGAGED history saved, week {top_history_data['week_start_date']} recorded and counts reset.")
 
     # Notify owner
-    try:
-        owner_message = f"مرحباً بك! تم تحديث قائمة TOP ENGAGED وإعلان الفائزين الجدد:{owner_and_deputy_notification_text_details}\n\nتفضل بالمراجعة."
-        await bot.send_message(OWNER_ID, owner_message)
-        logging.info(f"Owner {OWNER_ID} notified about TOP ENGAGED update.")
-    except TelegramForbiddenError:
-        logging.error(f"Cannot send message to owner {OWNER_ID}. User blocked bot.")
-    except Exception as e:
-        logging.error(f"Error sending owner notification: {e}")
+    await notify_owner(f"مرحباً بك! تم تحديث قائمة TOP ENGAGED وإعلان الفائزين الجدد:{owner_and_deputy_notification_text_details}\n\nتفضل بالمراجعة.")
 
-    # Notify deputies
-    await db_cursor.execute("SELECT user_id FROM deputies")
-    deputy_ids = [row[0] for row in await db_cursor.fetchall()]
+    # Notify deputies concurrently; NOTIFY_SEMAPHORE caps the fan-out so a
+    # long deputy list cannot trip Telegram's global send limit. Names come
+    # from the deputies table, saving a get_chat round trip per deputy.
+    deputy_rows = db_conn.execute("SELECT user_id, username, full_name FROM deputies")
 
-    for deputy_id in deputy_ids:
+    async def notify_one(deputy_id: int, username, full_name):
         try:
-            deputy_info = await bot.get_chat(deputy_id)
             # Prioritize username, then full_name, then just ID
-            deputy_name = deputy_info.username if deputy_info.username else deputy_info.full_name if deputy_info.full_name else f"صديقي (ID: {deputy_id})"
+            deputy_name = username if username else full_name if full_name else f"صديقي (ID: {deputy_id})"
             deputy_notification_message = f"مرحباً {deputy_name}، تم تحديث قائمة TOP ENGAGED وإعلان الفائزين الجدد:{owner_and_deputy_notification_text_details}\n\nتفضل بالمراجعة."
-            await bot.send_message(deputy_id, deputy_notification_message)
+            async with NOTIFY_SEMAPHORE:
+                await bot.send_message(deputy_id, deputy_notification_message)
             logging.info(f"Deputy {deputy_id} notified about TOP ENGAGED update.")
         except TelegramForbiddenError:
             logging.warning(f"Cannot send message to deputy {deputy_id}. User blocked bot.")
         except Exception as e:
             logging.error(f"Error sending notification to deputy {deputy_id}: {e}")
 
+    await asyncio.gather(*(notify_one(*row) for row in deputy_rows), return_exceptions=True)
+
+
+async def demote_old_top_engaged(chat_id: int):
+    """
+    Demotes last week's 'TOP ENGAGED' winners, removing their custom titles
+    and administrative privileges. Uses the winner IDs recorded at promotion
+    time, so only up to three targeted API calls are made instead of
+    fetching and scanning the whole admin list.
+    """
+    stored = None
+    if db_conn is not None:
+        result = db_conn.execute(SQL_GET_SETTING, ('previous_top_engaged_ids',)).fetchone()
+        if result and result[0]:
+            stored = result[0]
+    if stored is None:
+        # First run, or a database from before the winner IDs were recorded:
+        # fall back to the full admin scan once.
+        await demote_top_engaged_by_scan(chat_id)
+        return
+
+    try:
+        previous_ids = json.loads(stored)
+    except ValueError:
+        logging.error(f"Invalid previous_top_engaged_ids value in DB: {stored}")
+        return
+    if not previous_ids:
+        return
+
+    logging.info(f"Demoting previous TOP ENGAGED winners {previous_ids} in chat {chat_id}")
+
+    async def demote_one(user_id: int):
+        try:
+            await rate_limited_call(lambda: bot.promote_chat_member(
+                chat_id=chat_id,
+                user_id=user_id,
+                can_manage_chat=False,
+                can_delete_messages=False,
+                can_manage_video_chats=False,
+                can_restrict_members=False,
+                can_promote_members=False,
+                can_change_info=False,
+                can_invite_users=False,
+                can_pin_messages=False,
+                can_post_messages=False # Ensure all are False
+            ))
+            logging.info(f"Successfully demoted user {user_id} and removed custom title.")
+        except TelegramForbiddenError:
+            logging.warning(f"Bot lacks permission to demote user {user_id} in chat {chat_id}")
+        except TelegramBadRequest as e:
+            logging.warning(f"Failed to demote user {user_id}: {e}")
+        except Exception as e:
+            logging.error(f"Error demoting user {user_id}: {e}")
+
+    await asyncio.gather(*(demote_one(uid) for uid in previous_ids), return_exceptions=True)
+
+
+async def demote_top_engaged_by_scan(chat_id: int):
+    """
+    Fallback demotion: fetches all chat administrators and demotes anyone
+    whose custom title marks them as 'TOP ENGAGED'. Kept for first runs and
+    for the manual /admin_cleanup command.
+    """
+    logging.info(f"Demoting old TOP ENGAGED users in chat {chat_id}")
+    try:
+        # Get current chat administrators
+        admins = await bot.get_chat_administrators(chat_id)
+
+        for admin in admins:
+            user_id = admin.user.id
+            custom_title = admin.custom_title
+
+            # Check if the custom title indicates a 'TOP ENGAGED' winner
+            if custom_title and ("TOP ENGAGED" in custom_title.upper()):
+                logging.info(f"Found old TOP ENGAGED admin: {admin.user.full_name} (ID: {user_id}) with title: {custom_title}")
+                try:
+                    # Remove all administrative privileges, effectively demoting them to a regular member
+                    # This also removes the custom title. The rate limiter
+                    # replaces the old fixed inter-call sleep.
+                    await rate_limited_call(lambda: bot.promote_chat_member(
+                        chat_id=chat_id,
+                        user_id=user_id,
+                        can_manage_chat=False,
+                        can_delete_messages=False,
+                        can_manage_video_chats=False,
+                        can_restrict_members=False,
+                        can_promote_members=False,
+                        can_change_info=False,
+                        can_invite_users=False,
+                        can_pin_messages=False,
+                        can_post_messages=False # Ensure all are False
+                    ))
+                    logging.info(f"Successfully demoted {admin.user.full_name} (ID: {user_id}) and removed custom title.")
+                except TelegramForbiddenError:
+                    logging.warning(f"Bot lacks permission to demote user {user_id} in chat {chat_id}")
+                except TelegramBadRequest as e:
+                    logging.warning(f"Failed to demote user {user_id}: {e}")
+                except Exception as e:
+                    logging.error(f"Error demoting user {user_id}: {e}")
+
+    except TelegramForbiddenError:
+        logging.error(f"Bot lacks 'can_promote_members' permission in chat {chat_id}. Cannot demote old TOP ENGAGED users.")
+    except Exception as e:
+        logging.error(f"Error getting chat administrators or demoting users in chat {chat_id}: {e}")
+
+
+def next_weekly_anchor(now: datetime, weekday: int = 1) -> datetime:
+    """يحسب منتصف ليل يوم الأسبوع القادم (الثلاثاء افتراضياً) بعد `now` حصراً."""
+    # `or 7` يجعل النتيجة دائماً في المستقبل، حتى لو كان اليوم هو اليوم المطلوب.
+    days_ahead = (weekday - now.weekday()) % 7 or 7
+    return (now + timedelta(days=days_ahead)).replace(hour=0, minute=0, second=0, microsecond=0)
+
 
 async def schedule_top_engaged_task():
     """تجدول مهمة حساب وإعلان الأكثر تفاعلاً لتشغيلها أسبوعياً."""
     # انتظر حتى يتم تهيئة قاعدة البيانات
-    while db_cursor is None:
-        logging.info("جارٍ انتظار تهيئة قاعدة البيانات...")
-        await asyncio.sleep(1)
+    await DB_READY.wait()
 
+    # تشغيل تعويضي لمرة واحدة عند الإقلاع: إذا لم يتم الإعلان عن الأسبوع
+    # الحالي بعد (البوت كان متوقفاً وقت الموعد)، شغّل الإعلان فوراً.
+    # نفس حارس السجل وإعادة المحاولة المستخدم في الحلقة المستقرة أدناه؛
+    # خطأ عابر هنا لا يجب أن يقتل مهمة الجدولة بأكملها.
     while True:
-        now = datetime.now(SAUDI_ARABIA_TIMEZONE)
+        try:
+            now = datetime.now(SAUDI_ARABIA_TIMEZONE)
+            result = db_conn.execute(SQL_GET_SETTING, ('last_announced_week_start_date',)).fetchone()
+            last_announced_date = None
+            if result and result[0]:
+                try:
+                    last_announced_date = datetime.strptime(result[0], '%Y-%m-%d').replace(tzinfo=SAUDI_ARABIA_TIMEZONE)
+                except ValueError:
+                    logging.error(f"Invalid last_announced_week_start_date in DB: {result[0]}")
+
+            # الثلاثاء هو اليوم رقم 1 في الأسبوع (الاثنين هو 0، الأحد هو 6)
+            days_since_last_tuesday = (now.weekday() - 1) % 7
+            current_week_start = (now - timedelta(days=days_since_last_tuesday)).replace(hour=0, minute=0, second=0, microsecond=0)
+            if last_announced_date is None or last_announced_date < current_week_start:
+                logging.info(f"Announcement not yet made for the week starting {current_week_start}. Running immediately.")
+                await calculate_and_announce_top_engaged()
+            break
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logging.exception("Startup catch-up announcement failed; retrying in 60 seconds.")
+            await asyncio.sleep(60)
 
-        # 1. جلب تاريخ آخر إعلان من قاعدة البيانات
-        await db_cursor.execute("SELECT setting_value FROM bot_settings WHERE setting_name = 'last_announced_week_start_date'")
-        result = await db_cursor.fetchone()
-        last_announced_date_str = result[0] if result else None
-        last_announced_date = None
-        if last_announced_date_str:
-            try:
-                # تحويل التاريخ المخزن إلى كائن datetime مع المنطقة الزمنية
-                last_announced_date = datetime.strptime(last_announced_date_str, '%Y-%m-%d').replace(tzinfo=SAUDI_ARABIA_TIMEZONE)
-            except ValueError:
-                logging.error(f"Invalid last_announced_week_start_date in DB: {last_announced_date_str}")
-                last_announced_date = None
-
-        # 2. حساب بداية الأسبوع الحالي (منتصف ليل الثلاثاء الماضي أو الحالي)
-        # الثلاثاء هو اليوم رقم 1 في الأسبوع (الاثنين هو 0، الأحد هو 6)
-        days_since_last_tuesday = (now.weekday() - 1 + 7) % 7
-        current_week_start = (now - timedelta(days=days_since_last_tuesday)).replace(hour=0, minute=0, second=0, microsecond=0)
-
-        # 3. حساب وقت التشغيل المجدول التالي (منتصف ليل الثلاثاء القادم)
-        # إذا كان اليوم هو الثلاثاء والوقت بعد منتصف الليل، فالتشغيل التالي هو الثلاثاء القادم.
-        # وإلا، فهو الثلاثاء الحالي.
-        next_tuesday = now + timedelta(days=(1 - now.weekday() + 7) % 7)
-        next_scheduled_run = next_tuesday.replace(hour=0, minute=0, second=0, microsecond=0)
-
-        # إذا كان 'now' قد تجاوز 'next_scheduled_run' (على سبيل المثال، الآن الثلاثاء 00:01، و next_scheduled_run هو الثلاثاء 00:00)،
-        # فهذا يعني أن التشغيل الفعلي التالي هو بعد أسبوع من ذلك.
-        if now > next_scheduled_run:
-            next_scheduled_run += timedelta(weeks=1)
-
-        # 4. تحديد ما إذا كان يجب التشغيل فوراً
-        should_run_now = False
-        # إذا كان الوقت الحالي قد تجاوز بداية الأسبوع الحالي، ولم يتم الإعلان عن هذا الأسبوع بعد
-        if now >= current_week_start and \
-           (last_announced_date is None or last_announced_date < current_week_start):
-            logging.info(f"Current time ({now}) is past current week's start ({current_week_start}) and announcement not yet made for this week. Running immediately.")
-            should_run_now = True
-        
-        # 5. تنفيذ الإعلان إذا لزم الأمر
-        if should_run_now:
-            await calculate_and_announce_top_engaged()
-            # بعد التشغيل الفوري، نحتاج إلى التأكد من أن النوم التالي سيكون حتى الثلاثاء القادم.
-            # next_scheduled_run يشير بالفعل إلى الثلاثاء القادم.
-            time_to_sleep = (next_scheduled_run - datetime.now(SAUDI_ARABIA_TIMEZONE)).total_seconds()
-            if time_to_sleep <= 0: # احتياطي إذا كان الحساب خاطئاً قليلاً أو تغير الوقت
-                time_to_sleep = 60 # انتظر دقيقة واحدة على الأقل لتجنب حلقة ضيقة
-        else:
-            # إذا لم يكن هناك حاجة للتشغيل الفوري، فنم حتى وقت التشغيل المجدول التالي.
-            time_to_sleep = (next_scheduled_run - now).total_seconds()
-            if time_to_sleep <= 0: # لا ينبغي أن يحدث هذا إذا كان المنطق صحيحاً، ولكن كإجراء وقائي
-                time_to_sleep = 60 # انتظر دقيقة واحدة على الأقل
+    # الحالة المستقرة: نم حتى منتصف ليل الثلاثاء القادم ثم شغّل الإعلان.
+    # لا حاجة لإعادة قراءة الإعدادات هنا؛ الاستيقاظ يعني أن موعد الإعلان حان.
+    while True:
+        now = datetime.now(SAUDI_ARABIA_TIMEZONE)
+        next_scheduled_run = next_weekly_anchor(now)
+        time_to_sleep = max((next_scheduled_run - now).total_seconds(), 60)
 
         logging.info(f"إعلان الأكثر تفاعلاً التالي مجدول لـ: {next_scheduled_run.strftime('%Y-%m-%d %H:%M:%S')} (النوم لمدة {time_to_sleep} ثانية)")
         await asyncio.sleep(time_to_sleep)
 
-        # 6. بعد الاستيقاظ من النوم، هذا يعني أننا وصلنا إلى وقت التشغيل المجدول.
-        # يجب علينا دائماً تشغيل المهمة هنا.
         logging.info("استيقظت لتشغيل مهمة إعلان الأكثر تفاعلاً المجدولة.")
-        await calculate_and_announce_top_engaged()
+        try:
+            await calculate_and_announce_top_engaged()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # خطأ عابر لا يجب أن يقتل مهمة الجدولة؛ حاول مجدداً بعد دقيقة.
+            logging.exception("Scheduled announcement failed; retrying in 60 seconds.")
+            await asyncio.sleep(60)
 
 
 
@@ -504,9 +830,9 @@ async def schedule_top_engaged_task():
 # --- Message Handlers ---
 
 @router.message(Command("delete"))
-async def delete_message_command(message: types.Message):
+async def delete_message_command(message: types.Message, is_privileged: bool):
     """Allows the owner or deputies to delete a replied-to message."""
-    if not is_owner(message.from_user.id) and not await is_deputy(message.from_user.id):
+    if not is_privileged:
         await message.reply("ليس لديك الصلاحية لاستخدام هذا الأمر.")
         return
 
@@ -529,8 +855,10 @@ async def delete_message_command(message: types.Message):
 async def start_handler(message: types.Message):
     """Handles the /start command."""
     if message.chat.type == ChatType.PRIVATE:
-        me = await bot.get_me()
-        invite_link = f'https://t.me/{me.username}?startgroup=true'
+        global BOT_USERNAME
+        if BOT_USERNAME is None:  # Fallback if startup hasn't populated it yet
+            BOT_USERNAME = (await bot.get_me()).username
+        invite_link = f'https://t.me/{BOT_USERNAME}?startgroup=true'
         keyboard = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="إضافة لقروب", url=invite_link)]])
         await message.answer(
             "أهلاً بك! أنا بوت Top Engaged. أضفني لقروبك لبدء تتبع التفاعل الأسبوعي وإعلان الفائزين.\n\n"
@@ -541,7 +869,7 @@ async def start_handler(message: types.Message):
         await message.answer("مرحباً! أنا جاهز للعمل في هذه المجموعة. تأكد أنني مشرف.")
 
 @router.message(Command("help"))
-async def help_handler(message: types.Message):
+async def help_handler(message: types.Message, is_privileged: bool):
     """Handles the /help command."""
     help_text = (
         "أوامري بسيطة:\n"
@@ -559,7 +887,7 @@ async def help_handler(message: types.Message):
         "• `/set_main_group`: لتعيين المجموعة الحالية كمجموعة رئيسية لتتبع TOP ENGAGED. (يجب أن يكون البوت مشرفًا هنا)\n"
         "• `/run_top_now`: لتشغيل عملية TOP ENGAGED وإعلان الفائزين فوراً (للاختبار أو التعديل الفوري)."
     )
-    if message.from_user is None or not (is_owner(message.from_user.id) or await is_deputy(message.from_user.id)):
+    if not is_privileged:
         await message.answer(help_text)
     else:
         await message.answer(help_text.split("أوامر المالك (تستخدم في الخاص مع البوت فقط):")[0].strip()) # Show only user commands
@@ -567,36 +895,37 @@ async def help_handler(message: types.Message):
 @router.message(Command("my_messages"))
 async def my_messages_handler(message: types.Message):
     """Shows user's message count for the current week."""
-    if db_cursor is None:
-        await message.reply("عذراً، قاعدة البيانات غير متاحة حالياً.")
+    if db_conn is None:
+        await message.reply(MSG_DB_UNAVAILABLE)
         return
 
     try:
         user_id = message.from_user.id
-        await db_cursor.execute("SELECT message_count FROM message_counts WHERE user_id=?", (user_id,))
-        row = await db_cursor.fetchone()
-        count = row[0] if row else 0
+        row = db_conn.execute(SQL_GET_USER_COUNT, (user_id,)).fetchone()
+        count = row["message_count"] if row else 0
         await message.reply(f"عدد رسائلك لهذا الأسبوع: {count}")
     except Exception as e:
         logging.error(f"Error getting message count: {e}")
         await message.reply("حدث خطأ أثناء جلب عدد الرسائل.")
 
 @router.message(Command("top_this_week"))
-async def top_this_week_handler(message: types.Message):
+async def top_this_week_handler(message: types.Message, is_privileged: bool):
     """Displays the current week's top engaged users."""
     
-    if message.from_user is None or not (is_owner(message.from_user.id) or await is_deputy(message.from_user.id)):
+    if not is_privileged:
         await message.reply("ليس لديك صلاحية لعرض أعلى المستخدمين تفاعلاً. هذا الأمر متاح فقط للمالك والنواب.")
         return
         
-    if db_cursor is None:
-        await message.reply("عذراً، قاعدة البيانات غير متاحة حالياً.")
+    if db_conn is None:
+        await message.reply(MSG_DB_UNAVAILABLE)
         return
 
     try:
-        await db_cursor.execute("SELECT user_id, username, full_name, message_count FROM message_counts ORDER BY message_count DESC LIMIT 3")
-        top_users = await db_cursor.fetchall()
-        actual_top_users = [user for user in top_users if user[3] > 0] # user[3] هو message_count
+        # Fold any buffered increments in first so the live view is exact,
+        # then let the covering index serve the top three directly.
+        await flush_pending_counts()
+        # SQL_TOP3 already excludes zero counts, so no Python-side filter.
+        actual_top_users = db_conn.execute(SQL_TOP3).fetchall()
 
     except Exception as e:
         logging.error(f"Error getting top users: {e}")
@@ -616,35 +945,34 @@ async def top_this_week_handler(message: types.Message):
 @router.message(Command("history_top"))
 async def history_top_handler(message: types.Message):
     """Displays the history of top engaged users."""
-    if db_cursor is None:
-        await message.reply("عذراً، قاعدة البيانات غير متاحة حالياً.")
+    if db_conn is None:
+        await message.reply(MSG_DB_UNAVAILABLE)
         return
 
     try:
-        await db_cursor.execute("SELECT week_start_date, top_1_username, top_2_username, top_3_username FROM top_engaged_history ORDER BY week_start_date DESC LIMIT 1")
-        history = await db_cursor.fetchall()
+        row = db_conn.execute("SELECT week_start_date, top_1_username, top_2_username, top_3_username FROM top_engaged_history ORDER BY week_start_date DESC LIMIT 1").fetchone()
     except Exception as e:
         logging.error(f"Error getting history: {e}")
         await message.reply("حدث خطأ أثناء جلب التاريخ.")
         return
 
-    if not history:
+    if row is None:
         await message.reply("لا يوجد سجل سابق للفائزين بـ TOP ENGAGED.")
         return
 
+    date, top1, top2, top3 = row
     response = "سجل الفائزين بـ TOP ENGAGED (آخر أسبوع):\n"
-    for date, top1, top2, top3 in history:
-        response += f"\nالأسبوع الذي بدأ في: {date}\n"
-        response += f"1. {top1 if top1 else 'غير متاح'}\n"
-        response += f"2. {top2 if top2 else 'غير متاح'}\n"
-        response += f"3. {top3 if top3 else 'غير متاح'}\n"
+    response += f"\nالأسبوع الذي بدأ في: {date}\n"
+    response += f"1. {top1 if top1 else 'غير متاح'}\n"
+    response += f"2. {top2 if top2 else 'غير متاح'}\n"
+    response += f"3. {top3 if top3 else 'غير متاح'}\n"
     await message.reply(response)
 
 @router.message(Command("set_main_group"))
-async def set_main_group_handler(message: types.Message):
+async def set_main_group_handler(message: types.Message, is_privileged: bool):
     """Sets the current chat as the main group for TOP ENGAGED."""
     # Modified condition to allow owner OR deputy
-    if message.from_user is None or not (is_owner(message.from_user.id) or await is_deputy(message.from_user.id)):
+    if not is_privileged:
         await message.reply("ليس لديك صلاحية لتعيين المجموعة الرئيسية. هذا الأمر متاح فقط للمالك والنواب.")
         return
 
@@ -656,34 +984,77 @@ async def set_main_group_handler(message: types.Message):
     await message.reply(f"تم تعيين هذه المجموعة ({message.chat.title}) كمجموعة رئيسية لتتبع TOP ENGAGED. سيتم الإعلان هنا أسبوعياً.")
 
 @router.message(Command("run_top_now"))
-async def run_top_now_handler(message: types.Message):
+async def run_top_now_handler(message: types.Message, is_privileged: bool):
     """Manually triggers the TOP ENGAGED calculation and announcement."""
-    if message.from_user is None or not (is_owner(message.from_user.id) or await is_deputy(message.from_user.id)):
-        await message.reply("ليس لديك صلاحية لتشغيل هذا الأمر.")
+    if not is_privileged:
+        await message.reply(MSG_NO_RUN_PERMISSION)
         return
 
     await message.reply("جاري حساب وإعلان TOP ENGAGED الآن...")
-    await calculate_and_announce_top_engaged()
-    await message.answer("تمت عملية TOP ENGAGED بنجاح.")
+
+    # The weekly job spans many rate-limited API calls; run it as its own
+    # task so this handler frees its dispatch slot immediately.
+    async def run_and_confirm():
+        try:
+            await calculate_and_announce_top_engaged()
+            await message.answer("تمت عملية TOP ENGAGED بنجاح.")
+        except Exception as e:
+            logging.error(f"Manual TOP ENGAGED run failed: {e}")
+            await message.answer("حدث خطأ أثناء تشغيل عملية TOP ENGAGED.")
+
+    asyncio.create_task(run_and_confirm())
+
+@router.message(Command("admin_cleanup"))
+async def admin_cleanup_handler(message: types.Message, is_privileged: bool):
+    """Manually demotes any admin still carrying a TOP ENGAGED title."""
+    if not is_privileged:
+        await message.reply(MSG_NO_RUN_PERMISSION)
+        return
+
+    main_group_id = await get_group_chat_id()
+    if main_group_id is None:
+        await message.reply("لم يتم تعيين المجموعة الرئيسية بعد. استخدم /set_main_group أولاً.")
+        return
+
+    await message.reply("جاري فحص قائمة المشرفين وإزالة ألقاب TOP ENGAGED القديمة...")
+    await demote_top_engaged_by_scan(main_group_id)
+    await message.answer("تم تنظيف قائمة المشرفين.")
 
 # --- Owner/Deputy Commands (mainly in private chat for deputies management) ---
 
-@router.message(Command("add_deputy"))
-async def add_deputy(message: types.Message):
+async def enrich_deputy_reply(sent: types.Message, deputy_id: int, template: str,
+                              store_name: bool = False):
+    """Resolves a deputy's display name in the background and edits the
+    ID-only confirmation in place; on any failure the plain reply stands."""
+    try:
+        names = get_cached_deputy_name(deputy_id)
+        if names is None:
+            info = await bot.get_chat(deputy_id)
+            names = (info.username, info.full_name)
+            cache_deputy_name(deputy_id, *names)
+        username, full_name = names
+        if store_name and db_conn is not None:
+            db_conn.execute("UPDATE deputies SET username=?, full_name=?, cached_at=? WHERE user_id=?",
+                            (username, full_name, int(time.time()), deputy_id))
+            db_conn.commit()
+        display = username if username else full_name
+        if display:
+            await sent.edit_text(template.format(name=display, id=deputy_id))
+    except Exception as e:
+        logging.warning(f"Could not enrich deputy reply for ID {deputy_id}: {e}")
+
+@router.message(Command("add_deputy"), F.chat.type == ChatType.PRIVATE)
+async def add_deputy(message: types.Message, is_owner_user: bool):
     """Handles making a user a deputy using /add_deputy <user_id>."""
-    if message.from_user is None or not is_owner(message.from_user.id):
+    if not is_owner_user:
         await message.reply("فقط المالك يمكنه تعيين النواب.")
         return
-    if message.chat.type != ChatType.PRIVATE:
-        await message.reply("يجب استخدام هذا الأمر في المحادثة الخاصة مع البوت.")
-        return
-
-    if db_cursor is None:
-        await message.reply("عذراً، قاعدة البيانات غير متاحة حالياً.")
+    if db_conn is None:
+        await message.reply(MSG_DB_UNAVAILABLE)
         return
 
     if message.text is None:
-        await message.reply("هذا الأمر يتطلب نصًا.")
+        await message.reply(MSG_COMMAND_NEEDS_TEXT)
         return
     args = message.text.split(maxsplit=1)
     if len(args) != 2:
@@ -692,40 +1063,35 @@ async def add_deputy(message: types.Message):
 
     try:
         deputy_id = int(args[1])
-        await db_cursor.execute("INSERT OR IGNORE INTO deputies (user_id) VALUES (?)", (deputy_id,))
+        db_conn.execute("INSERT OR IGNORE INTO deputies (user_id) VALUES (?)", (deputy_id,))
         if db_conn:
-            await db_conn.commit()
+            db_conn.commit()
+        DEPUTIES.add(deputy_id)
 
-        # Try to get user info for a more friendly message
-        try:
-            deputy_user_info = await bot.get_chat(deputy_id) # Use get_chat for private chat
-            username = deputy_user_info.username if deputy_user_info.username else deputy_user_info.full_name
-            await message.reply(f"تم تعيين {username} (ID: {deputy_id}) نائبًا.")
-        except Exception:
-            await message.reply(f"تم تعيين المستخدم بمعرف {deputy_id} نائبًا. (تعذر جلب اسمه).")
+        # Confirm with the numeric ID immediately; name resolution happens in
+        # the background and edits this reply once the get_chat returns.
+        sent = await message.reply(f"تم تعيين المستخدم بمعرف {deputy_id} نائبًا.")
+        asyncio.create_task(enrich_deputy_reply(
+            sent, deputy_id, "تم تعيين {name} (ID: {id}) نائبًا.", store_name=True))
 
     except ValueError:
-        await message.reply("معرف المستخدم (user_id) يجب أن يكون رقمًا.")
+        await message.reply(MSG_USER_ID_NOT_NUMERIC)
     except Exception as e:
         logging.error(f"Error making deputy: {e}")
         await message.reply("حدث خطأ أثناء تعيين النائب.")
 
-@router.message(Command("remove_deputy"))
-async def remove_deputy(message: types.Message):
+@router.message(Command("remove_deputy"), F.chat.type == ChatType.PRIVATE)
+async def remove_deputy(message: types.Message, is_owner_user: bool):
     """Handles removing a user from deputy status using /remove_deputy <user_id>."""
-    if message.from_user is None or not is_owner(message.from_user.id):
+    if not is_owner_user:
         await message.reply("فقط المالك يمكنه عزل النواب.")
         return
-    if message.chat.type != ChatType.PRIVATE:
-        await message.reply("يجب استخدام هذا الأمر في المحادثة الخاصة مع البوت.")
-        return
-
-    if db_cursor is None:
-        await message.reply("عذراً، قاعدة البيانات غير متاحة حالياً.")
+    if db_conn is None:
+        await message.reply(MSG_DB_UNAVAILABLE)
         return
 
     if message.text is None:
-        await message.reply("هذا الأمر يتطلب نصًا.")
+        await message.reply(MSG_COMMAND_NEEDS_TEXT)
         return
     args = message.text.split(maxsplit=1)
     if len(args) != 2:
@@ -734,83 +1100,148 @@ async def remove_deputy(message: types.Message):
 
     try:
         deputy_id = int(args[1])
-        await db_cursor.execute("DELETE FROM deputies WHERE user_id=?", (deputy_id,))
+        db_conn.execute("DELETE FROM deputies WHERE user_id=?", (deputy_id,))
         if db_conn:
-            await db_conn.commit()
+            db_conn.commit()
+        DEPUTIES.discard(deputy_id)
 
-        # Try to get user info for a more friendly message
-        try:
-            deputy_user_info = await bot.get_chat(deputy_id)
-            username = deputy_user_info.username if deputy_user_info.username else deputy_user_info.full_name
-            await message.reply(f"تم عزل {username} (ID: {deputy_id}) من منصب النائب.")
-        except Exception:
-            await message.reply(f"تم عزل المستخدم بمعرف {deputy_id} من منصب النائب. (تعذر جلب اسمه).")
+        # Same immediate-confirm-then-enrich pattern as /add_deputy.
+        sent = await message.reply(f"تم عزل المستخدم بمعرف {deputy_id} من منصب النائب.")
+        asyncio.create_task(enrich_deputy_reply(
+            sent, deputy_id, "تم عزل {name} (ID: {id}) من منصب النائب."))
 
     except ValueError:
-        await message.reply("معرف المستخدم (user_id) يجب أن يكون رقمًا.")
+        await message.reply(MSG_USER_ID_NOT_NUMERIC)
     except Exception as e:
         logging.error(f"Error removing deputy: {e}")
         await message.reply("حدث خطأ أثناء عزل النائب.")
 
-@router.message(Command("list_deputies"))
-async def list_deputies(message: types.Message):
+@router.message(Command("list_deputies"), F.chat.type == ChatType.PRIVATE)
+async def list_deputies(message: types.Message, is_privileged: bool):
     """Handles displaying the list of deputies using /list_deputies command."""
-    if message.from_user is None or not (is_owner(message.from_user.id) or await is_deputy(message.from_user.id)):
+    if not is_privileged:
         await message.reply("ليس لديك صلاحية لعرض النواب.")
         return
-    if message.chat.type != ChatType.PRIVATE:
-        await message.reply("يجب استخدام هذا الأمر في المحادثة الخاصة مع البوت.")
+    if db_conn is None:
+        await message.reply(MSG_DB_UNAVAILABLE)
         return
 
-    if db_cursor is None:
-        await message.reply("عذراً، قاعدة البيانات غير متاحة حالياً.")
+    # The in-memory set answers the common empty case without touching the
+    # database at all.
+    if not DEPUTIES:
+        await message.reply(MSG_NO_DEPUTIES)
         return
 
-    await db_cursor.execute("SELECT user_id FROM deputies")
-    deputy_ids = [row[0] for row in await db_cursor.fetchall()]
+    # Names recorded at /add_deputy time, with message_counts as a fallback
+    # for deputies added before names were stored — both beat a network call.
+    deputy_ids = []
+    for row in db_conn.execute("""
+        SELECT d.user_id,
+               COALESCE(d.username, mc.username) AS username,
+               COALESCE(d.full_name, mc.full_name) AS full_name
+        FROM deputies d LEFT JOIN message_counts mc ON mc.user_id = d.user_id
+    """):
+        deputy_ids.append(row["user_id"])
+        if (row["username"] or row["full_name"]) and get_cached_deputy_name(row["user_id"]) is None:
+            cache_deputy_name(row["user_id"], row["username"], row["full_name"])
 
     if not deputy_ids:
-        await message.reply("لا يوجد نواب حاليًا.")
+        await message.reply(MSG_NO_DEPUTIES)
         return
 
+    # Resolve only the IDs still missing a name, all concurrently.
+    misses = [did for did in deputy_ids if get_cached_deputy_name(did) is None]
+
+    async def fetch_chat(did: int):
+        async with NOTIFY_SEMAPHORE:
+            return await bot.get_chat(did)
+
+    if misses:
+        results = await asyncio.gather(*(fetch_chat(did) for did in misses), return_exceptions=True)
+        for did, result in zip(misses, results):
+            if isinstance(result, Exception):
+                logging.warning(f"Could not fetch deputy info for ID: {did} - {result}")
+            else:
+                cache_deputy_name(did, result.username, result.full_name)
+
     deputy_list = []
     for deputy_id in deputy_ids:
-        try:
-            member = await bot.get_chat(deputy_id) # Use get_chat
-            username = member.username
-            full_name = member.full_name
-            deputy_list.append(f"- {full_name} (@{username})" if username else f"- {full_name} (ID: {deputy_id})")
-        except Exception as e:
-            logging.warning(f"Could not fetch deputy info for ID: {deputy_id} - {e}")
+        cached = get_cached_deputy_name(deputy_id)
+        if cached is None:
             deputy_list.append(f"- (معرف غير معروف) (ID: {deputy_id})")
+        else:
+            username, full_name = cached
+            deputy_list.append(f"- {full_name} (@{username})" if username else f"- {full_name} (ID: {deputy_id})")
 
     await message.reply("قائمة النواب:\n" + "\n".join(deputy_list))
 
-@router.message(Command("clear_deputies"))
-async def clear_deputies(message: types.Message):
+@router.message(Command("clear_deputies"), F.chat.type == ChatType.PRIVATE)
+async def clear_deputies(message: types.Message, is_owner_user: bool):
     """Handles clearing all deputies using /clear_deputies command."""
-    if message.from_user is None or not is_owner(message.from_user.id):
+    if not is_owner_user:
         await message.reply("فقط المالك يمكنه مسح النواب.")
         return
-    if message.chat.type != ChatType.PRIVATE:
-        await message.reply("يجب استخدام هذا الأمر في المحادثة الخاصة مع البوت.")
-        return
-
-    if db_cursor is None:
-        await message.reply("عذراً، قاعدة البيانات غير متاحة حالياً.")
+    if db_conn is None:
+        await message.reply(MSG_DB_UNAVAILABLE)
         return
 
-    await db_cursor.execute("DELETE FROM deputies")
+    db_conn.execute("DELETE FROM deputies")
     if db_conn:
-        await db_conn.commit()
+        db_conn.commit()
+    DEPUTIES.clear()
     await message.reply("تم إزالة جميع النواب بنجاح.")
 
+@router.message(Command("refresh_deputies"), F.chat.type == ChatType.PRIVATE)
+async def refresh_deputies(message: types.Message, is_owner_user: bool):
+    """Re-resolves every deputy's name from Telegram and stores it."""
+    if not is_owner_user:
+        await message.reply("فقط المالك يمكنه تحديث بيانات النواب.")
+        return
+    if db_conn is None:
+        await message.reply(MSG_DB_UNAVAILABLE)
+        return
+    if not DEPUTIES:
+        await message.reply(MSG_NO_DEPUTIES)
+        return
+
+    deputy_ids = sorted(DEPUTIES)
+
+    async def fetch_chat(did: int):
+        async with NOTIFY_SEMAPHORE:
+            return await bot.get_chat(did)
+
+    results = await asyncio.gather(*(fetch_chat(did) for did in deputy_ids), return_exceptions=True)
+    refreshed = []
+    now = int(time.time())
+    for did, result in zip(deputy_ids, results):
+        if isinstance(result, Exception):
+            logging.warning(f"Could not refresh deputy info for ID: {did} - {result}")
+        else:
+            refreshed.append((result.username, result.full_name, now, did))
+            cache_deputy_name(did, result.username, result.full_name)
+    if refreshed:
+        try:
+            db_conn.execute("BEGIN IMMEDIATE")
+            db_conn.executemany("UPDATE deputies SET username=?, full_name=?, cached_at=? WHERE user_id=?", refreshed)
+            db_conn.commit()
+        except Exception as e:
+            # Roll back so the shared connection isn't left mid-transaction.
+            db_conn.rollback()
+            logging.error(f"Failed to store refreshed deputy names: {e}")
+            await message.reply("حدث خطأ أثناء حفظ بيانات النواب.")
+            return
+
+    await message.reply(f"تم تحديث بيانات {len(refreshed)} من أصل {len(deputy_ids)} نائبًا.")
+
 # --- Message Counter (Listens to all messages in groups) ---
 @router.message(F.chat.type.in_([ChatType.GROUP, ChatType.SUPERGROUP]))
 async def message_counter(message: types.Message):
     """Increments message count for users in tracked groups."""
-    if db_cursor is None or db_conn is None:
-        return  # Skip counting if database isn't ready
+    # Cheapest check first: messages outside the main group are the common
+    # case for a bot sitting in several chats, so reject them before touching
+    # any user attributes.
+    if MAIN_GROUP_ID is None or message.chat.id != MAIN_GROUP_ID:
+        return
 
     user = message.from_user
     if user is None:
@@ -820,43 +1251,40 @@ async def message_counter(message: types.Message):
     username = user.username if user.username else None
     full_name = user.full_name
 
-    # Only count messages if the group ID matches the set main group ID
-    main_group_id = await get_group_chat_id()
-    if main_group_id and message.chat.id == main_group_id:
-        await db_cursor.execute(
-            "INSERT OR IGNORE INTO message_counts (user_id, username, full_name, message_count) VALUES (?, ?, ?, 0)",
-            (user_id, username, full_name)
-        )
-        # Update username and full_name in case they changed
-        await db_cursor.execute(
-            "UPDATE message_counts SET message_count = message_count + 1, username = ?, full_name = ? WHERE user_id = ?",
-            (username, full_name, user_id)
-        )
-        if db_conn:
-            await db_conn.commit()
-        # logging.info(f"Message from {full_name} ({user_id}) counted. Current count: {count + 1 if count else 1}")
-    else:
-        # logging.info(f"Message from {full_name} ({user_id}) in chat {message.chat.id} not counted. Not maingroup.")
-        pass # Do not log every message to avoid cluttering logs
+    # Buffer the increment in memory; the background flusher writes it out.
+    pending_counts[user_id] += 1
+    pending_names[user_id] = (username, full_name)
+    if len(pending_counts) >= FLUSH_THRESHOLD:
+        FLUSH_WAKEUP.set()
 
 # --- Main function to run the bot ---
 async def main():
     """Main function to start the bot and its background tasks."""
+    global BOT_USERNAME
     dp.include_router(router)
 
-    # Start the web interface in a separate thread
-    from web_interface import run_web_server
-    import threading
-    web_thread = threading.Thread(target=run_web_server, daemon=True)
-    web_thread.start()
+    # Cache the bot's username once so /start never needs a get_me call
+    BOT_USERNAME = (await bot.get_me()).username
+
+    # Start the web interface on the same event loop (no extra thread)
+    from web_interface import serve_web
+    asyncio.create_task(serve_web())
     logging.info("Web interface started on http://0.0.0.0:5000")
 
     # Start the background task for scheduling TOP ENGAGED
     asyncio.create_task(schedule_top_engaged_task())
 
+    # Start the background task that flushes buffered message counts
+    asyncio.create_task(flush_counts_task())
+
+    # Start the background task that keeps the WAL file small
+    asyncio.create_task(wal_checkpoint_task())
+
     # Start polling for updates
     logging.info("Starting bot polling...")
-    await dp.start_polling(bot)
+    # Only message updates are handled, so let Telegram drop everything else
+    # server-side, and hold each long poll open longer between requests.
+    await dp.start_polling(bot, allowed_updates=["message"], polling_timeout=50)
 
 if __name__ == '__main__':
     asyncio.run(main())
@@ -1,15 +1,18 @@
 
-from flask import Flask, render_template_string
-import threading
+from flask import Flask, make_response, request
 import asyncio
+import hashlib
 from datetime import datetime
-import pytz
+from zoneinfo import ZoneInfo
+import uvicorn
+from asgiref.wsgi import WsgiToAsgi
 
 app = Flask(__name__)
 
-@app.route('/')
-def home():
-    template = """
+# Resolved once; looking the zone up per request is wasted work.
+RIYADH_TZ = ZoneInfo('Asia/Riyadh')
+
+TEMPLATE_STR = """
     <!DOCTYPE html>
     <html>
     <head>
@@ -27,7 +30,7 @@ def home():
             <h1>🔝 TOP Engaged Bot - Admin Panel</h1>
             <div class="status">
                 <h3>Bot Status: ✅ Running</h3>
-                <p>Last updated: {{ current_time }}</p>
+                <p>Last updated: __TS__</p>
             </div>
             <div class="info">
                 <h3>Bot Information</h3>
@@ -49,11 +52,25 @@ def home():
     </body>
     </html>
     """
-    saudi_time = datetime.now(pytz.timezone('Asia/Riyadh'))
-    return render_template_string(template, current_time=saudi_time.strftime('%Y-%m-%d %H:%M:%S'))
 
-def run_web_server():
-    app.run(host='0.0.0.0', port=5000, debug=False)
+# The page is static apart from the timestamp, so render it fully at import
+# and substitute the __TS__ placeholder per request.
+BASE_HTML = app.jinja_env.from_string(TEMPLATE_STR).render()
+
+@app.route('/')
+def home():
+    ts = datetime.now(RIYADH_TZ).strftime('%Y-%m-%d %H:%M:%S')
+    response = make_response(BASE_HTML.replace('__TS__', ts))
+    # Let browsers and proxies reuse the page briefly and revalidate cheaply.
+    response.headers['Cache-Control'] = 'public, max-age=5'
+    response.set_etag(hashlib.blake2b(ts.encode(), digest_size=8).hexdigest())
+    return response.make_conditional(request)
+
+async def serve_web():
+    """Serves the admin panel on the caller's asyncio event loop."""
+    config = uvicorn.Config(WsgiToAsgi(app), host='0.0.0.0', port=5000,
+                            loop='asyncio', log_level='warning')
+    await uvicorn.Server(config).serve()
 
 if __name__ == '__main__':
-    run_web_server()
+    asyncio.run(serve_web())